@@ -1,87 +1,299 @@
 import hashlib
-import json
+import orjson
+import queue
+import shutil
+import threading
 import time
 import os
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
+import fast_hash
 
 # Configure logging
 logger = logging.getLogger("blockchain")
 
 class Blockchain:
-    def __init__(self, storage_file: str = "blockchain.json"):
+    def __init__(self, storage_file: str = "blockchain.json", tx_dir: str = "txs",
+                 block_max_txs: int = 64, block_max_age: float = 1.0):
         self.storage_file = storage_file
+        self.tx_dir = tx_dir
+        self.block_max_txs = block_max_txs
+        self.block_max_age = block_max_age  # seconds
         self.chain = []
-        self.current_transactions = []
+        # Pending transactions as (leaf hash, canonical JSON bytes), serialized once on arrival
+        self.current_transactions: List[Tuple[bytes, bytes]] = []
+        self._first_pending_ts = 0.0
+        self._last_hash = "1"
+        self._last_transactions: List[bytes] = []
+        self.status_dirty = True  # set whenever a block is added
+        
+        if not os.path.exists(tx_dir):
+            os.makedirs(tx_dir)
         
         # Try to load existing blockchain
         self._load_chain()
+        if self.chain:
+            last_block = self.chain[-1]
+            self._last_hash = last_block.get('hash') or self.hash(last_block)
+            self._last_transactions = self._load_transactions(last_block['index'])
+        
+        # Persist blocks on a background writer so sealing never waits on fsync
+        self._write_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
         
-        # Create genesis block if chain is empty
+        # Create genesis block if chain is empty, writing it before returning
+        # so another Blockchain on the same file sees it
         if not self.chain:
             logger.info("Creating genesis block")
             self.create_block(previous_hash="1")
-            self._save_chain()
+            self.flush()
     
     def create_block(self, previous_hash: str) -> Dict[str, Any]:
         """Create a new block in the blockchain"""
+        tx_hashes = [tx_hash for tx_hash, _ in self.current_transactions]
+        transactions = [tx for _, tx in self.current_transactions]
+        
+        # The header commits to the transactions through their Merkle root,
+        # the transactions themselves live in a sidecar file
         block = {
             'index': len(self.chain) + 1,
             'timestamp': time.time(),
-            'transactions': self.current_transactions,
+            'merkle_root': self._merkle_root(tx_hashes),
+            'tx_count': len(transactions),
             'previous_hash': previous_hash,
         }
         
+        # Hash once and keep it so the next block never re-serializes this one
+        block_hash = self.hash(block)
+        block['hash'] = block_hash
+        self._last_hash = block_hash
+        
         # Clear current transactions and add block to chain
         self.current_transactions = []
+        self._last_transactions = transactions
         self.chain.append(block)
+        self.status_dirty = True
         
-        # Save chain to disk
-        self._save_chain()
+        # Hand the block to the writer thread
+        self._write_queue.put((block, transactions))
         
         logger.info(f"Created block {block['index']}")
         return block
     
     def add_transaction(self, transaction: Dict[str, Any]) -> int:
-        """Add a new transaction to the list of transactions"""
-        self.current_transactions.append({
+        """Queue a transaction, sealing a block once the batch is full or old enough"""
+        now = time.time()
+        if not self.current_transactions:
+            self._first_pending_ts = now
+        tx = orjson.dumps({
             'data': transaction,
-            'timestamp': time.time()
-        })
+            'timestamp': now
+        }, option=orjson.OPT_SORT_KEYS)
+        self.current_transactions.append((fast_hash.sha256(tx), tx))
+        index = len(self.chain) + 1
         
-        # Create a new block if there are transactions
-        if len(self.current_transactions) >= 1:
-            last_block = self.chain[-1]
-            self.create_block(self.hash(last_block))
+        # Seal the pending batch into a block
+        if (len(self.current_transactions) >= self.block_max_txs
+                or now - self._first_pending_ts >= self.block_max_age):
+            self.flush(wait=False)
         
         logger.info(f"Added transaction: {transaction.get('hash', '')}")
-        return self.get_last_block()['index'] if self.chain else None
+        return index
+    
+    def flush(self, wait: bool = True) -> Optional[Dict[str, Any]]:
+        """Seal any pending transactions into a new block, optionally waiting
+        until every sealed block has been written to disk"""
+        block = None
+        if self.current_transactions:
+            block = self.create_block(self._last_hash)
+        
+        if wait:
+            done = threading.Event()
+            self._write_queue.put(done)
+            done.wait()
+        return block
     
     @staticmethod
     def hash(block: Dict[str, Any]) -> str:
         """Create a SHA-256 hash of a block"""
-        block_string = json.dumps(block, sort_keys=True).encode()
+        block_string = orjson.dumps(block, option=orjson.OPT_SORT_KEYS)
         return hashlib.sha256(block_string).hexdigest()
     
+    @staticmethod
+    def _merkle_root(tx_hashes: List[bytes]) -> str:
+        """Compute the Merkle root over transaction leaf hashes"""
+        if not tx_hashes:
+            return "0" * 64
+        
+        # Keep each level as one contiguous buffer of 32-byte nodes so a
+        # whole level can be hashed in a single batched call
+        nodes = b"".join(tx_hashes)
+        while len(nodes) > 32:
+            # Duplicate the last node on odd levels
+            if len(nodes) % 64:
+                nodes += nodes[-32:]
+            nodes = fast_hash.merkle_level(nodes)
+        return nodes.hex()
+    
     def get_last_block(self) -> Optional[Dict[str, Any]]:
-        """Get the last block in the blockchain"""
-        return self.chain[-1] if self.chain else None
+        """Get the last block in the blockchain, including its transactions"""
+        if not self.chain:
+            return None
+        last_block = self.chain[-1]
+        if 'transactions' in last_block:
+            return last_block
+        transactions = [orjson.loads(tx) for tx in self._last_transactions]
+        return {**last_block, 'transactions': transactions}
+    
+    def get_transactions(self, index: int) -> List[Dict[str, Any]]:
+        """Get the transactions recorded in the block with the given index"""
+        block = self.chain[index - 1]
+        if 'transactions' in block:
+            # Blocks written before Merkle roots kept transactions inline
+            return block['transactions']
+        return [orjson.loads(tx) for tx in self._load_transactions(index)]
+    
+    def _load_transactions(self, index: int) -> List[bytes]:
+        """Read a block's serialized transactions from its sidecar file"""
+        block = self.chain[index - 1]
+        if 'transactions' in block or not block.get('tx_count'):
+            return []
+        
+        try:
+            with open(self._tx_file(block), 'rb') as f:
+                return [line.rstrip(b'\n') for line in f if line.strip()]
+        except Exception as e:
+            logger.error(f"Failed to load transactions for block {index}: {str(e)}")
+            return []
+    
+    def _tx_file(self, block: Dict[str, Any]) -> str:
+        """Path of the sidecar file holding a block's transactions. Keyed by
+        block hash so a chain restarted from index 1 cannot overwrite it."""
+        return os.path.join(self.tx_dir, f"{block['hash']}.jsonl")
+    
+    def _save_transactions(self, block: Dict[str, Any], transactions: List[bytes]) -> None:
+        """Write a block's transactions to its sidecar file"""
+        if not transactions:
+            return
+        try:
+            with open(self._tx_file(block), 'xb') as f:
+                for tx in transactions:
+                    f.write(tx + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            logger.error(f"Failed to save transactions for block {block['index']}: {str(e)}")
+    
+    def _writer_loop(self) -> None:
+        """Write queued blocks to disk in order"""
+        while True:
+            item = self._write_queue.get()
+            if isinstance(item, threading.Event):
+                # Everything queued before this marker has been written
+                item.set()
+                continue
+            
+            block, transactions = item
+            # Write the transactions before the header that references them
+            self._save_transactions(block, transactions)
+            self._append_block(block)
     
-    def _save_chain(self) -> None:
-        """Save the blockchain to disk"""
+    def _append_block(self, block: Dict[str, Any]) -> None:
+        """Append a single block to the on-disk log (one JSON object per line)"""
         try:
-            with open(self.storage_file, 'w') as f:
-                json.dump(self.chain, f)
+            with open(self.storage_file, 'ab') as f:
+                f.write(orjson.dumps(block) + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
         except Exception as e:
-            logger.error(f"Failed to save blockchain: {str(e)}")
+            logger.error(f"Failed to save block {block['index']}: {str(e)}")
     
     def _load_chain(self) -> None:
         """Load the blockchain from disk"""
+        # Finish a migration that was interrupted after its copy was made durable
+        if os.path.exists(self._migrated_file):
+            self._replace_storage(self._migrated_file)
+        
         if os.path.exists(self.storage_file):
             try:
-                with open(self.storage_file, 'r') as f:
-                    self.chain = json.load(f)
+                with open(self.storage_file, 'rb') as f:
+                    # Older nodes stored the whole chain as a single JSON array
+                    legacy = f.read(1) == b'['
+                    f.seek(0)
+                    if legacy:
+                        self.chain = orjson.loads(f.read())
+                    else:
+                        self.chain = self._read_log(f)
+                
+                if legacy:
+                    self._migrate_chain()
                 logger.info(f"Loaded blockchain with {len(self.chain)} blocks")
             except Exception as e:
+                # Refuse to start rather than append a new genesis block to a
+                # log that still holds the chain we could not read
                 logger.error(f"Failed to load blockchain: {str(e)}")
-                self.chain = []
\ No newline at end of file
+                raise
+    
+    def _read_log(self, f) -> List[Dict[str, Any]]:
+        """Read the append-only log, repairing a torn final line left by a crash"""
+        data = f.read()
+        chain = []
+        offset = 0
+        while offset < len(data):
+            newline = data.find(b'\n', offset)
+            line_end = len(data) if newline == -1 else newline + 1
+            line = data[offset:line_end]
+            if line.strip():
+                try:
+                    chain.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # Only the last record can be torn by a crashed append
+                    if data[line_end:].strip():
+                        raise
+                    logger.warning(f"Discarding torn final block in {self.storage_file}")
+                    self._repair_log(truncate_at=offset)
+                    return chain
+            offset = line_end
+        
+        if data and not data.endswith(b'\n'):
+            # The last block is whole but lost its newline
+            self._repair_log(truncate_at=len(data), newline=True)
+        return chain
+    
+    def _repair_log(self, truncate_at: int, newline: bool = False) -> None:
+        """Cut the log back to its last complete block so appends start cleanly"""
+        with open(self.storage_file, 'r+b') as f:
+            f.truncate(truncate_at)
+            if newline:
+                f.seek(truncate_at)
+                f.write(b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+    
+    @property
+    def _migrated_file(self) -> str:
+        """Durable copy of a migrated chain, kept until it replaces storage_file"""
+        return f"{self.storage_file}.migrated"
+    
+    def _migrate_chain(self) -> None:
+        """Rewrite a legacy JSON array chain file in the append-only format"""
+        tmp_file = f"{self.storage_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            for block in self.chain:
+                f.write(orjson.dumps(block) + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self._migrated_file)
+        
+        self._replace_storage(self._migrated_file)
+        logger.info(f"Migrated {self.storage_file} to append-only format")
+    
+    def _replace_storage(self, source: str) -> None:
+        """Copy source over storage_file and remove it. Copying rather than
+        renaming keeps working when storage_file is a bind-mounted file."""
+        with open(source, 'rb') as src, open(self.storage_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(source)
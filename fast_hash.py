@@ -0,0 +1,171 @@
+import functools
+import hashlib
+import importlib
+import importlib.util
+import logging
+from typing import Any, Callable, List, Optional
+
+# Configure logging
+logger = logging.getLogger("fast_hash")
+
+# Optional SHA-256 bindings that dispatch to SHA-NI / ARMv8 SHA2 assembly.
+# Each must expose a hashlib-compatible ``sha256`` constructor.
+_ACCELERATED_MODULES = ("sha256_simd", "hashlib_sha256_ni", "isal.hash", "pysha256ni")
+
+# Optional Merkle backends exposing ``merkle_level(nodes: bytes) -> bytes``, in
+# order of preference: native libraries doing their own AVX-512 / AVX2 / SSE4 /
+# SHA-NI lane dispatch, then the Numba JIT tier, then pure Python
+_MERKLE_MODULES = ("hashtree", "sha256_simd", "merkle_numba")
+
+# Optional multi-buffer backends exposing ``sha256_many(buffers) -> digests``,
+# hashing independent messages in parallel SIMD lanes (SSE4 / AVX2 / AVX-512)
+_MULTIBUFFER_MODULES = ("sha256_simd", "isal.hash")
+
+# Software SHA-256 tiers, only worth it when hashlib can't use SHA instructions,
+# mapped to the package they need
+_SOFTWARE_MERKLE_MODULES = {"merkle_numba": "numba"}
+
+# CPU flags (as reported by py-cpuinfo) that indicate SHA-256 instructions
+_SHA_CPU_FLAGS = {"sha_ni", "sha", "sha2"}
+
+@functools.lru_cache(maxsize=None)
+def _cpu_has_sha_extensions() -> bool:
+    """Check whether the CPU advertises SHA-256 instructions. py-cpuinfo takes
+    about a second, so this only runs once a backend actually needs the answer."""
+    try:
+        import cpuinfo
+    except ImportError:
+        return False
+
+    try:
+        flags = set(cpuinfo.get_cpu_info().get("flags", []))
+    except Exception as e:
+        logger.warning(f"CPU feature detection failed: {str(e)}")
+        return False
+    return bool(flags & _SHA_CPU_FLAGS)
+
+def _load_accelerated_sha256() -> Optional[Callable[..., Any]]:
+    """Return the first usable accelerated sha256 constructor, if any"""
+    expected = hashlib.sha256(b"abc").hexdigest()
+    for module_name in _ACCELERATED_MODULES:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+
+        constructor = getattr(module, "sha256", None)
+        if constructor is None:
+            continue
+
+        # The binding is only used when the instructions are actually present
+        if not _cpu_has_sha_extensions():
+            return None
+
+        # Only trust a backend that agrees with hashlib
+        try:
+            if constructor(b"abc").hexdigest() != expected:
+                continue
+        except Exception:
+            continue
+
+        logger.info(f"Using accelerated SHA-256 backend: {module_name}")
+        return constructor
+    return None
+
+_sha256 = _load_accelerated_sha256() or hashlib.sha256
+
+def _merkle_level_py(nodes: bytes) -> bytes:
+    """Hash each 64-byte pair of child nodes into a 32-byte parent"""
+    sha = _sha256
+    view = memoryview(nodes)
+    return b"".join(sha(view[i:i + 64]).digest() for i in range(0, len(view), 64))
+
+def _load_merkle_backend() -> Callable[[bytes], bytes]:
+    """Return the fastest available Merkle level implementation"""
+    sample = bytes(range(128))
+    expected = _merkle_level_py(sample)
+    for module_name in _MERKLE_MODULES:
+        if module_name in _SOFTWARE_MERKLE_MODULES:
+            required = _SOFTWARE_MERKLE_MODULES[module_name]
+            if importlib.util.find_spec(required) is None or _cpu_has_sha_extensions():
+                continue
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        except Exception as e:
+            # e.g. the Numba tier failing to compile
+            logger.warning(f"Merkle backend {module_name} unavailable: {str(e)}")
+            continue
+
+        level = getattr(module, "merkle_level", None)
+        if level is None:
+            continue
+
+        # Only trust a backend that agrees with the reference implementation
+        try:
+            if bytes(level(sample)) != expected:
+                continue
+        except Exception:
+            continue
+
+        logger.info(f"Using Merkle backend: {module_name}")
+        return level
+    return _merkle_level_py
+
+_merkle_level = _load_merkle_backend()
+
+def _sha256_many_py(buffers: List[bytes]) -> List[bytes]:
+    """Hash each buffer in turn"""
+    sha = _sha256
+    return [sha(buf).digest() for buf in buffers]
+
+def _load_multibuffer_backend() -> Callable[[List[bytes]], List[bytes]]:
+    """Return a multi-buffer SHA-256 implementation, if one is installed"""
+    sample = [b"", b"abc", bytes(100)]
+    expected = _sha256_many_py(sample)
+    for module_name in _MULTIBUFFER_MODULES:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+
+        many = getattr(module, "sha256_many", None)
+        if many is None:
+            continue
+
+        # Only trust a backend that agrees with the reference implementation
+        try:
+            if [bytes(d) for d in many(sample)] != expected:
+                continue
+        except Exception:
+            continue
+
+        logger.info(f"Using multi-buffer SHA-256 backend: {module_name}")
+        return many
+    return _sha256_many_py
+
+_sha256_many = _load_multibuffer_backend()
+
+def sha256_new() -> Any:
+    """Create an incremental SHA-256 hasher"""
+    return _sha256()
+
+def sha256(data: bytes) -> bytes:
+    """Return the raw SHA-256 digest of data"""
+    return _sha256(data).digest()
+
+def sha256_hex(data: bytes) -> str:
+    """Return the hex SHA-256 digest of data"""
+    return _sha256(data).hexdigest()
+
+def merkle_level(nodes: bytes) -> bytes:
+    """Hash a flat buffer of 64*n bytes (n sibling pairs) into 32*n bytes of parents"""
+    if len(nodes) % 64:
+        raise ValueError("Merkle level must be a multiple of 64 bytes")
+    return bytes(_merkle_level(nodes))
+
+def sha256_many(buffers: List[bytes]) -> List[bytes]:
+    """Return the raw SHA-256 digest of each buffer, hashing them side by side
+    when a multi-buffer backend is available"""
+    return [bytes(digest) for digest in _sha256_many(buffers)]
@@ -0,0 +1,101 @@
+import numpy as np
+from numba import njit, prange
+
+# Numba JIT Merkle level, used by fast_hash when no native backend is
+# installed. Importing this module raises ImportError without numpy/numba.
+
+_MASK = 0xFFFFFFFF
+
+# SHA-256 round constants and initial state
+_K = np.array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+], dtype=np.int64)
+
+_H0 = np.array([
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+], dtype=np.int64)
+
+# Words are held in int64 and masked to 32 bits, which keeps Numba's
+# integer typing simple and avoids unsigned/signed promotion to float
+
+@njit(cache=True)
+def _rotr(x, n):
+    return ((x >> n) | (x << (32 - n))) & _MASK
+
+@njit(cache=True)
+def _compress(state, w):
+    """Run the SHA-256 compression function over one 16-word block in w"""
+    for t in range(16, 64):
+        s0 = _rotr(w[t - 15], 7) ^ _rotr(w[t - 15], 18) ^ (w[t - 15] >> 3)
+        s1 = _rotr(w[t - 2], 17) ^ _rotr(w[t - 2], 19) ^ (w[t - 2] >> 10)
+        w[t] = (w[t - 16] + s0 + w[t - 7] + s1) & _MASK
+
+    a, b, c, d, e, f, g, h = state[0], state[1], state[2], state[3], state[4], state[5], state[6], state[7]
+    for t in range(64):
+        s1 = _rotr(e, 6) ^ _rotr(e, 11) ^ _rotr(e, 25)
+        ch = (e & f) ^ (~e & g)
+        t1 = (h + s1 + ch + _K[t] + w[t]) & _MASK
+        s0 = _rotr(a, 2) ^ _rotr(a, 13) ^ _rotr(a, 22)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        t2 = (s0 + maj) & _MASK
+        h = g
+        g = f
+        f = e
+        e = (d + t1) & _MASK
+        d = c
+        c = b
+        b = a
+        a = (t1 + t2) & _MASK
+
+    state[0] = (state[0] + a) & _MASK
+    state[1] = (state[1] + b) & _MASK
+    state[2] = (state[2] + c) & _MASK
+    state[3] = (state[3] + d) & _MASK
+    state[4] = (state[4] + e) & _MASK
+    state[5] = (state[5] + f) & _MASK
+    state[6] = (state[6] + g) & _MASK
+    state[7] = (state[7] + h) & _MASK
+
+@njit(parallel=True, cache=True)
+def _merkle_level_numba(buf):
+    """Hash each 64-byte pair in a uint8 array into a 32-byte parent"""
+    n = buf.shape[0] // 64
+    out = np.empty(n * 32, dtype=np.uint8)
+    for i in prange(n):
+        state = _H0.copy()
+        w = np.zeros(64, dtype=np.int64)
+
+        # First block: the two 32-byte children
+        base = 64 * i
+        for j in range(16):
+            p = base + 4 * j
+            w[j] = (np.int64(buf[p]) << 24) | (np.int64(buf[p + 1]) << 16) | (np.int64(buf[p + 2]) << 8) | np.int64(buf[p + 3])
+        _compress(state, w)
+
+        # Second block: padding for a 512-bit message
+        w[:] = 0
+        w[0] = 0x80000000
+        w[15] = 512
+        _compress(state, w)
+
+        for j in range(8):
+            p = 32 * i + 4 * j
+            out[p] = (state[j] >> 24) & 0xFF
+            out[p + 1] = (state[j] >> 16) & 0xFF
+            out[p + 2] = (state[j] >> 8) & 0xFF
+            out[p + 3] = state[j] & 0xFF
+    return out
+
+def merkle_level(nodes: bytes) -> bytes:
+    """Hash a flat buffer of 64*n bytes into 32*n bytes of parents"""
+    return _merkle_level_numba(np.frombuffer(nodes, dtype=np.uint8)).tobytes()
+
+# Compile up front with a two-leaf level so the first block doesn't pay for it
+merkle_level(bytes(64))
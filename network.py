@@ -1,30 +1,105 @@
-import requests
+import asyncio
+import httpx
+import mmap
 import os
+import tempfile
+import uuid
 import logging
-import time
-from typing import Set, Dict, Any, Optional
-import hashlib
+from typing import Set, Dict, List, Any, Optional, AsyncIterator, Union, BinaryIO, Tuple
+import fast_hash
 
 # Configure logging
 logger = logging.getLogger("network")
 
+# Chunk size used when streaming downloads to disk
+CHUNK_SIZE = 1024 * 1024
+
+# Files up to this size are fetched into memory and hash-verified in batches
+SMALL_FILE_LIMIT = 1024 * 1024
+
+# Number of small files verified together, one per multi-buffer SHA lane
+VERIFY_BATCH = 8
+
+# Base delay in seconds between broadcast retries, doubled on each attempt
+RETRY_BACKOFF = 2
+
+# Process umask, read once since os.umask can only be queried by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def make_temp_file(directory: str, prefix: str) -> Tuple[int, str]:
+    """Create a temp file like tempfile.mkstemp, but with the permissions a plain
+    open() would give, since mkstemp's 0600 survives the rename into place"""
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=prefix)
+    try:
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+    except OSError:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    return fd, tmp_path
+
+class FileTooLargeError(Exception):
+    """A peer sent more bytes than the size it advertised for a small file"""
+
+class PipelinedWriter:
+    """Writes chunks to a file on a worker thread so each disk write overlaps
+    with receiving the next chunk"""
+    def __init__(self, f: BinaryIO):
+        self._file = f
+        self._pending: Optional[asyncio.Future] = None
+    
+    async def write(self, chunk: bytes) -> None:
+        """Wait for the previous write, then submit this one"""
+        await self.drain()
+        self._pending = asyncio.ensure_future(asyncio.to_thread(self._file.write, chunk))
+    
+    async def drain(self) -> None:
+        """Wait for the in-flight write, if any"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            await pending
+
 class Network:
-    def __init__(self, peer_file: str = "peers.txt", retry_limit: int = 3):
+    def __init__(self, peer_file: str = "peers.txt", retry_limit: int = 3,
+                 upload_dir: str = "uploads", local_hashes: Optional[Set[str]] = None,
+                 pool_size: int = 64):
         self.peers: Set[str] = set()
         self.peer_file = peer_file
         self.retry_limit = retry_limit
+        self.upload_dir = upload_dir
+        # Shared with the owning node so both see files as they land
+        self.local_hashes = local_hashes if local_hashes is not None else set()
+        # One keep-alive pool for all peer traffic, so repeated /status polls,
+        # uploads and downloads reuse connections instead of reconnecting
+        self._client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size
+            )
+        )
+        self.status_dirty = True  # set whenever the peer set changes
+        # Downloads in progress, keyed by file hash; each future resolves to
+        # whether the file was stored, so other peers' syncs don't race it
+        self._in_flight: Dict[str, asyncio.Future] = {}
         
         # Load existing peers
         self._load_peers()
     
-    def add_peer(self, peer_url: str) -> bool:
+    async def close(self) -> None:
+        """Close pooled peer connections"""
+        await self._client.aclose()
+    
+    async def add_peer(self, peer_url: str) -> bool:
         """Add a peer to the network"""
         if not peer_url.startswith(('http://', 'https://')):
             peer_url = f"http://{peer_url}"
             
         # Validate peer before adding
-        if self._validate_peer(peer_url):
+        if await self._validate_peer(peer_url):
             self.peers.add(peer_url)
+            self.status_dirty = True
             self._save_peers()
             logger.info(f"Added peer: {peer_url}")
             return True
@@ -34,121 +109,321 @@ class Network:
         """Remove a peer from the network"""
         if peer_url in self.peers:
             self.peers.remove(peer_url)
+            self.status_dirty = True
             self._save_peers()
             logger.info(f"Removed peer: {peer_url}")
     
-    def broadcast_file(self, file_path: str) -> Dict[str, Any]:
+    async def broadcast_file(self, file_path: str) -> Dict[str, Any]:
         """Broadcast a file to all peers"""
         results = {"success": [], "failed": []}
         
-        for peer in self.peers:
-            success = False
-            
-            for attempt in range(self.retry_limit):
-                try:
-                    with open(file_path, "rb") as f:
-                        files = {"file": f}
-                        response = requests.post(
-                            f"{peer}/upload", 
-                            files=files, 
-                            timeout=30
-                        )
-                        
-                    if response.status_code == 200:
-                        results["success"].append(peer)
-                        success = True
-                        logger.info(f"File broadcast successful to {peer}")
-                        break
-                        
-                except requests.exceptions.RequestException as e:
-                    logger.warning(f"Attempt {attempt+1} failed to send file to {peer}: {str(e)}")
-                    time.sleep(2)  # Wait before retry
-            
-            if not success:
+        peers = list(self.peers)
+        if not peers:
+            return results
+        
+        # Map the file once and share it between all peers and retries
+        filename = os.path.basename(file_path)
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        
+        try:
+            sent = await asyncio.gather(
+                *[self._send_one(peer, filename, data) for peer in peers],
+                return_exceptions=True
+            )
+        finally:
+            if size:
+                data.close()
+        
+        for peer, success in zip(peers, sent):
+            if success is True:
+                results["success"].append(peer)
+            else:
                 results["failed"].append(peer)
                 logger.error(f"Failed to broadcast file to {peer} after {self.retry_limit} attempts")
         
         return results
     
-    def sync_files(self) -> Dict[str, Any]:
+    async def _send_one(self, peer: str, filename: str, data: Union[mmap.mmap, bytes]) -> bool:
+        """Send a file to a single peer, retrying with exponential backoff"""
+        for attempt in range(self.retry_limit):
+            try:
+                boundary = uuid.uuid4().hex
+                head = (
+                    f"--{boundary}\r\n"
+                    f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                    f"Content-Type: application/octet-stream\r\n\r\n"
+                ).encode()
+                tail = f"\r\n--{boundary}--\r\n".encode()
+                
+                response = await self._client.post(
+                    f"{peer}/upload", 
+                    content=self._multipart_body(head, data, tail),
+                    headers={
+                        "Content-Type": f"multipart/form-data; boundary={boundary}",
+                        "Content-Length": str(len(head) + len(data) + len(tail)),
+                    },
+                    timeout=30
+                )
+                    
+                if response.status_code == 200:
+                    logger.info(f"File broadcast successful to {peer}")
+                    return True
+                    
+            except httpx.HTTPError as e:
+                logger.warning(f"Attempt {attempt+1} failed to send file to {peer}: {str(e)}")
+                if attempt + 1 < self.retry_limit:
+                    await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)  # Wait before retry
+        
+        return False
+    
+    @staticmethod
+    async def _multipart_body(head: bytes, data: Union[mmap.mmap, bytes], tail: bytes) -> AsyncIterator[bytes]:
+        """Stream a single-file multipart body in CHUNK_SIZE slices"""
+        yield head
+        for offset in range(0, len(data), CHUNK_SIZE):
+            yield data[offset:offset + CHUNK_SIZE]
+        yield tail
+    
+    async def sync_files(self) -> Dict[str, Any]:
         """Sync files with all peers"""
         results = {"synced": 0, "failed": 0, "peers": {}}
         
-        for peer in self.peers:
-            peer_result = {"status": "failed", "files": 0}
+        peers = list(self.peers)
+        peer_results = await asyncio.gather(
+            *[self._sync_peer(peer) for peer in peers],
+            return_exceptions=True
+        )
+        
+        for peer, peer_result in zip(peers, peer_results):
+            if isinstance(peer_result, Exception):
+                # One misbehaving peer must not abort the sync for the rest
+                logger.error(f"Failed to sync with {peer}: {str(peer_result)}")
+                peer_result = {"status": "failed", "files": 0}
             
-            try:
-                response = requests.get(f"{peer}/status", timeout=10)
-                if response.status_code == 200:
-                    last_block = response.json().get("last_block", {})
-                    transactions = last_block.get("transactions", [])
-                    
-                    for tx in transactions:
-                        file_hash = tx.get("data", {}).get("hash")
-                        if file_hash:
-                            if self._download_file(peer, file_hash):
-                                peer_result["files"] += 1
-                    
-                    peer_result["status"] = "success"
-                    results["synced"] += peer_result["files"]
-                    logger.info(f"Successfully synced with {peer}, got {peer_result['files']} files")
-                    
-                else:
-                    results["failed"] += 1
-                    logger.warning(f"Failed to sync with {peer}: HTTP {response.status_code}")
-                    
-            except requests.exceptions.RequestException as e:
+            if peer_result["status"] == "success":
+                results["synced"] += peer_result["files"]
+            else:
                 results["failed"] += 1
-                logger.error(f"Failed to sync with {peer}: {str(e)}")
-            
             results["peers"][peer] = peer_result
         
         return results
     
-    def _download_file(self, peer: str, file_hash: str) -> bool:
-        """Download a file from a peer"""
-        file_path = os.path.join("uploads", file_hash)
+    async def _sync_peer(self, peer: str) -> Dict[str, Any]:
+        """Download the files referenced by a peer's last block"""
+        peer_result = {"status": "failed", "files": 0}
         
-        # Skip if file already exists
-        if os.path.exists(file_path):
-            return True
-            
         try:
-            response = requests.get(
-                f"{peer}/retrieve/{file_hash}", 
-                stream=True,
-                timeout=30
-            )
-            
+            response = await self._client.get(f"{peer}/status", timeout=10)
             if response.status_code == 200:
-                with open(file_path, "wb") as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
+                last_block = response.json().get("last_block", {})
+                transactions = last_block.get("transactions", [])
+                
+                # Split missing files by advertised size: small ones are
+                # verified in batches, large ones stream straight to disk
+                small, large = [], []
+                seen: Set[str] = set()
+                for tx in transactions:
+                    data = tx.get("data", {})
+                    file_hash = data.get("hash")
+                    if not file_hash or file_hash in seen:
+                        continue
+                    seen.add(file_hash)
+                    if file_hash in self.local_hashes:
+                        peer_result["files"] += 1
+                    elif isinstance(data.get("size"), int) and data["size"] <= SMALL_FILE_LIMIT:
+                        small.append(file_hash)
+                    else:
+                        large.append(file_hash)
                 
-                # Verify hash
-                with open(file_path, "rb") as f:
-                    content = f.read()
-                    computed_hash = hashlib.sha256(content).hexdigest()
+                for i in range(0, len(small), VERIFY_BATCH):
+                    peer_result["files"] += await self._download_batch(peer, small[i:i + VERIFY_BATCH])
                 
-                if computed_hash != file_hash:
+                for file_hash in large:
+                    if await self._download_file(peer, file_hash):
+                        peer_result["files"] += 1
+                
+                peer_result["status"] = "success"
+                logger.info(f"Successfully synced with {peer}, got {peer_result['files']} files")
+                
+            else:
+                logger.warning(f"Failed to sync with {peer}: HTTP {response.status_code}")
+                
+        except httpx.HTTPError as e:
+            logger.error(f"Failed to sync with {peer}: {str(e)}")
+        except (ValueError, AttributeError, TypeError) as e:
+            # Malformed /status payload, e.g. non-JSON or a null last_block
+            logger.error(f"Invalid status from {peer}: {str(e)}")
+        
+        return peer_result
+    
+    async def _wait_in_flight(self, file_hash: str) -> bool:
+        """Wait out other downloads of a file, returning whether it is now stored"""
+        while file_hash in self._in_flight:
+            await asyncio.shield(self._in_flight[file_hash])
+        return file_hash in self.local_hashes
+    
+    def _claim(self, file_hash: str) -> None:
+        """Mark a file as being downloaded"""
+        self._in_flight[file_hash] = asyncio.get_running_loop().create_future()
+    
+    def _release(self, file_hash: str, stored: bool) -> None:
+        """Clear a download claim and wake anyone waiting on it"""
+        self._in_flight.pop(file_hash).set_result(stored)
+    
+    async def _download_batch(self, peer: str, file_hashes: List[str]) -> int:
+        """Fetch several small files concurrently and verify them together"""
+        stored = 0
+        claimed, deferred = [], []
+        for file_hash in file_hashes:
+            if file_hash in self.local_hashes:
+                stored += 1
+            elif file_hash in self._in_flight:
+                # Another peer is already fetching it, retry afterwards if that fails
+                deferred.append(file_hash)
+            else:
+                self._claim(file_hash)
+                claimed.append(file_hash)
+        
+        results = {file_hash: False for file_hash in claimed}
+        try:
+            bodies = await asyncio.gather(
+                *[self._fetch_small(peer, file_hash) for file_hash in claimed],
+                return_exceptions=True
+            )
+            fetched = []
+            for file_hash, body in zip(claimed, bodies):
+                if isinstance(body, FileTooLargeError):
+                    # Wrong size in the transaction; stream it like a large file instead
+                    deferred.append(file_hash)
+                elif isinstance(body, Exception):
+                    logger.error(f"Failed to download {file_hash} from {peer}: {str(body)}")
+                elif body is not None:
+                    fetched.append((file_hash, body))
+            digests = fast_hash.sha256_many([body for _, body in fetched])
+            
+            for (file_hash, body), digest in zip(fetched, digests):
+                if digest.hex() != file_hash:
                     logger.warning(f"Hash mismatch for file {file_hash} from {peer}")
-                    os.remove(file_path)
-                    return False
+                    continue
                 
+                try:
+                    await asyncio.to_thread(self._write_file, file_hash, body)
+                except OSError as e:
+                    logger.error(f"Failed to save {file_hash} from {peer}: {str(e)}")
+                    continue
+                self.local_hashes.add(file_hash)
+                results[file_hash] = True
                 logger.info(f"Downloaded {file_hash} from {peer}")
-                return True
+                stored += 1
+        finally:
+            for file_hash in claimed:
+                self._release(file_hash, results[file_hash])
+        
+        for file_hash in deferred:
+            if await self._download_file(peer, file_hash):
+                stored += 1
+        return stored
+    
+    async def _fetch_small(self, peer: str, file_hash: str) -> Optional[bytes]:
+        """Fetch a small file into memory, raising FileTooLargeError for bodies
+        over SMALL_FILE_LIMIT"""
+        try:
+            async with self._client.stream(
+                "GET",
+                f"{peer}/retrieve/{file_hash}",
+                timeout=30
+            ) as response:
+                if response.status_code != 200:
+                    return None
+                
+                body = bytearray()
+                async for chunk in response.aiter_bytes():
+                    body += chunk
+                    if len(body) > SMALL_FILE_LIMIT:
+                        logger.warning(f"File {file_hash} from {peer} is larger than advertised")
+                        raise FileTooLargeError(file_hash)
+                return bytes(body)
+                
+        except httpx.HTTPError as e:
+            logger.error(f"Failed to download {file_hash} from {peer}: {str(e)}")
+        return None
+    
+    def _write_file(self, file_hash: str, content: bytes) -> None:
+        """Write a verified file into upload_dir via a temp file"""
+        file_path = os.path.join(self.upload_dir, file_hash)
+        fd, tmp_path = make_temp_file(self.upload_dir, ".download-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    async def _download_file(self, peer: str, file_hash: str) -> bool:
+        """Download a file from a peer"""
+        # Skip if file already exists, or another peer just delivered it
+        if await self._wait_in_flight(file_hash):
+            return True
+        
+        self._claim(file_hash)
+        stored = False
+        try:
+            stored = await self._stream_file(peer, file_hash)
+        finally:
+            self._release(file_hash, stored)
+        return stored
+    
+    async def _stream_file(self, peer: str, file_hash: str) -> bool:
+        """Stream a file from a peer to disk, verifying its hash on the way"""
+        file_path = os.path.join(self.upload_dir, file_hash)
+        tmp_path = None
+            
+        try:
+            async with self._client.stream(
+                "GET",
+                f"{peer}/retrieve/{file_hash}", 
+                timeout=30
+            ) as response:
+                if response.status_code == 200:
+                    # Hash while writing so the file is only traversed once
+                    hasher = fast_hash.sha256_new()
+                    fd, tmp_path = make_temp_file(self.upload_dir, ".download-")
+                    with os.fdopen(fd, "wb") as f:
+                        writer = PipelinedWriter(f)
+                        try:
+                            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                                hasher.update(chunk)
+                                await writer.write(chunk)
+                        finally:
+                            await writer.drain()
+                    
+                    # Verify hash
+                    if hasher.hexdigest() != file_hash:
+                        logger.warning(f"Hash mismatch for file {file_hash} from {peer}")
+                        return False
+                    
+                    os.replace(tmp_path, file_path)
+                    self.local_hashes.add(file_hash)
+                    logger.info(f"Downloaded {file_hash} from {peer}")
+                    return True
                 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Failed to download {file_hash} from {peer}: {str(e)}")
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
         
         return False
     
-    def _validate_peer(self, peer_url: str) -> bool:
+    async def _validate_peer(self, peer_url: str) -> bool:
         """Validate a peer URL by checking its status endpoint"""
         try:
-            response = requests.get(f"{peer_url}/status", timeout=5)
+            response = await self._client.get(f"{peer_url}/status", timeout=5)
             return response.status_code == 200
-        except requests.exceptions.RequestException:
+        except httpx.HTTPError:
             return False
     
     def _save_peers(self) -> None:
@@ -1,11 +1,13 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
-import hashlib
+from fastapi.responses import FileResponse, JSONResponse, Response
+import asyncio
+import orjson
 import os
 import logging
-from typing import Dict, Any, Optional
+from typing import Set, Dict, Any, Optional, Tuple
 from blockchain import Blockchain
-from network import Network
+from network import Network, PipelinedWriter, make_temp_file
+import fast_hash
 
 # Configure logging
 logging.basicConfig(
@@ -15,63 +17,187 @@ logging.basicConfig(
 )
 logger = logging.getLogger("p2p_node")
 
+# Read size used when streaming uploads to disk
+CHUNK_SIZE = 1024 * 1024
+
+# Allowance for multipart framing on top of the file itself when
+# checking an upload's Content-Length
+MULTIPART_OVERHEAD = 64 * 1024
+
 class P2PNode:
     def __init__(self, upload_dir: str = "uploads", max_file_size: int = 100 * 1024 * 1024):
-        self.blockchain = Blockchain()
-        self.network = Network()
         self.upload_dir = upload_dir
         self.max_file_size = max_file_size  # 100MB default
         
         if not os.path.exists(upload_dir):
             os.makedirs(upload_dir)
+        
+        # Hashes of locally stored files (dot-prefixed names are in-flight temp files)
+        self.local_hashes: Set[str] = {
+            name for name in os.listdir(upload_dir) if not name.startswith(".")
+        }
+        
+        self.blockchain = Blockchain()
+        self.network = Network(upload_dir=upload_dir, local_hashes=self.local_hashes)
+        
+        self._flush_task: Optional[asyncio.Task] = None
+        self._cached_status: Optional[bytes] = None
+        # stat results for served files, so FileResponse does not re-stat
+        self._stat_cache: Dict[str, os.stat_result] = {}
+    
+    def has(self, file_hash: str) -> bool:
+        """Check whether a file is stored locally"""
+        return file_hash in self.local_hashes
+    
+    async def start(self) -> None:
+        """Start background tasks"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self) -> None:
+        """Stop background tasks and seal any pending transactions"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        self.blockchain.flush()
+        await self.network.close()
+    
+    async def _flush_loop(self) -> None:
+        """Periodically seal pending transactions so batches never go stale"""
+        while True:
+            await asyncio.sleep(self.blockchain.block_max_age)
+            try:
+                self.blockchain.flush(wait=False)
+            except Exception as e:
+                logger.error(f"Error sealing pending transactions: {str(e)}")
             
     async def store_file(self, file: UploadFile) -> Dict[str, Any]:
         """Store a file in the local filesystem and add it to the blockchain"""
+        if file.size is not None and file.size > self.max_file_size:
+            raise HTTPException(status_code=413, detail="File too large")
+        
+        # Stream into a temp file, hashing as we go, so memory stays O(chunk)
+        fd, tmp_path = make_temp_file(self.upload_dir, ".upload-")
         try:
-            # Check file size
-            file_content = await file.read()
-            if len(file_content) > self.max_file_size:
-                raise HTTPException(status_code=413, detail="File too large")
+            hasher = fast_hash.sha256_new()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                writer = PipelinedWriter(f)
+                try:
+                    while True:
+                        chunk = await file.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if size > self.max_file_size:
+                            raise HTTPException(status_code=413, detail="File too large")
+                        hasher.update(chunk)
+                        await writer.write(chunk)
+                finally:
+                    await writer.drain()
                 
-            # Hash the file content
-            file_hash = hashlib.sha256(file_content).hexdigest()
-            file_path = os.path.join(self.upload_dir, file_hash)
+            file_hash = hasher.hexdigest()
+            if file_hash in self.local_hashes:
+                # Already stored and recorded, e.g. a peer relaying our own
+                # broadcast back; re-adding it would bounce between peers forever
+                logger.info(f"File already stored: {file_hash}")
+                return {"hash": file_hash}
             
-            # Save the file
-            with open(file_path, "wb") as f:
-                f.write(file_content)
+            file_path = os.path.join(self.upload_dir, file_hash)
+            os.replace(tmp_path, file_path)
+            self.local_hashes.add(file_hash)
+            self._stat_cache[file_hash] = os.stat(file_path)
             
             # Add to blockchain
             self.blockchain.add_transaction({
                 "hash": file_hash, 
                 "filename": file.filename,
                 "content_type": file.content_type,
-                "size": len(file_content)
+                "size": size
             })
             
             # Broadcast to peers
-            self.network.broadcast_file(file_path)
+            await self.network.broadcast_file(file_path)
             
             logger.info(f"File stored successfully: {file_hash}")
             return {"hash": file_hash}
             
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error storing file: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error storing file: {str(e)}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
     
-    def retrieve_file(self, file_hash: str) -> Optional[str]:
-        """Retrieve a file from the local filesystem by its hash"""
-        file_path = os.path.join(self.upload_dir, file_hash)
-        if os.path.exists(file_path):
+    def get_status(self) -> bytes:
+        """Get the serialized status payload, rebuilt only after a new block or peer change"""
+        if self._cached_status is None or self.blockchain.status_dirty or self.network.status_dirty:
+            self.blockchain.status_dirty = False
+            self.network.status_dirty = False
+            self._cached_status = orjson.dumps({
+                "blockchain_length": len(self.blockchain.chain),
+                "peers": list(self.network.peers),
+                "last_block": self.blockchain.get_last_block()
+            })
+        return self._cached_status
+    
+    def retrieve_file(self, file_hash: str) -> Optional[Tuple[str, os.stat_result]]:
+        """Retrieve a file's path and stat result from the local filesystem by its hash"""
+        if self.has(file_hash):
+            file_path = os.path.join(self.upload_dir, file_hash)
+            stat = self._stat_cache.get(file_hash)
+            if stat is None:
+                # Files that arrived via sync or predate this process
+                stat = self._stat_cache[file_hash] = os.stat(file_path)
             logger.info(f"File retrieved: {file_hash}")
-            return file_path
+            return file_path, stat
         
         logger.warning(f"File not found: {file_hash}")
         return None
 
+class LargeFileResponse(FileResponse):
+    """FileResponse that streams in CHUNK_SIZE reads instead of Starlette's
+    64 KiB default, cutting per-chunk thread hops and ASGI sends 16-fold"""
+    chunk_size = CHUNK_SIZE
+
+class UploadSizeLimitMiddleware:
+    """Rejects uploads whose declared Content-Length is over the node's limit
+    before the request body is read. This has to run ahead of FastAPI, which
+    parses the whole multipart body before the endpoint is called."""
+    def __init__(self, app, node: P2PNode, path: str = "/upload"):
+        self.app = app
+        self.node = node
+        self.path = path
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == self.path:
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > self.node.max_file_size + MULTIPART_OVERHEAD:
+                        response = JSONResponse(status_code=413, content={"detail": "File too large"})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
 # Create FastAPI application
 app = FastAPI(title="PermastoreIt P2P Node", version="1.0.0")
 node = P2PNode()
+app.add_middleware(UploadSizeLimitMiddleware, node=node)
+
+@app.on_event("startup")
+async def startup():
+    await node.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await node.stop()
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
@@ -81,17 +207,14 @@ async def upload_file(file: UploadFile = File(...)):
 @app.get("/retrieve/{file_hash}")
 async def retrieve_file(file_hash: str):
     """Retrieve a file from the P2P network by its hash"""
-    file_path = node.retrieve_file(file_hash)
-    if file_path:
-        return FileResponse(file_path, filename=file_hash)
+    result = node.retrieve_file(file_hash)
+    if result:
+        file_path, stat = result
+        return LargeFileResponse(file_path, filename=file_hash, stat_result=stat)
     else:
         raise HTTPException(status_code=404, detail="File not found")
 
 @app.get("/status")
 async def get_status():
     """Get status information about the node"""
-    return {
-        "blockchain_length": len(node.blockchain.chain),
-        "peers": list(node.network.peers),
-        "last_block": node.blockchain.get_last_block()
-    }
\ No newline at end of file
+    return Response(content=node.get_status(), media_type="application/json")
\ No newline at end of file
@@ -1,15 +1,15 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Depends
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 import uvicorn
 import os
 import logging
-import json
+import orjson
 from typing import List, Dict, Any, Optional
 import hashlib
 
-from p2p_node import P2PNode
+from p2p_node import P2PNode, LargeFileResponse, UploadSizeLimitMiddleware
 
 # Configure logging
 logging.basicConfig(
@@ -26,20 +26,11 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # For production, replace with specific origins
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # Load configuration
 def load_config():
     try:
-        with open("config.json", "r") as f:
-            return json.load(f)
+        with open("config.json", "rb") as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         # Default configuration
         config = {
@@ -47,10 +38,12 @@ def load_config():
             "max_file_size": 100 * 1024 * 1024,  # 100MB
             "host": "0.0.0.0",
             "port": 5000,
-            "debug": False
+            "debug": False,
+            "loop": "auto",   # uvloop when installed
+            "http": "auto"    # httptools when installed
         }
-        with open("config.json", "w") as f:
-            json.dump(config, f, indent=2)
+        with open("config.json", "wb") as f:
+            f.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
         return config
 
 config = load_config()
@@ -61,6 +54,29 @@ node = P2PNode(
     max_file_size=config["max_file_size"]
 )
 
+# Reject oversized uploads from their Content-Length before reading the body.
+# Registered before CORS so CORS wraps it and its 413 carries CORS headers.
+app.add_middleware(UploadSizeLimitMiddleware, node=node)
+
+# Add CORS middleware
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # For production, replace with specific origins
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.on_event("startup")
+async def startup():
+    """Start background node tasks"""
+    await node.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Seal pending transactions before exiting"""
+    await node.stop()
+
 # Request models
 class PeerModel(BaseModel):
     url: str = Field(..., description="Peer URL to add to the network")
@@ -82,6 +98,8 @@ async def upload_file(file: UploadFile = File(...)):
     try:
         result = await node.store_file(file)
         return {"hash": result["hash"], "message": "File uploaded successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error uploading file: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -89,15 +107,16 @@ async def upload_file(file: UploadFile = File(...)):
 @app.get("/download/{file_hash}")
 async def download_file(file_hash: str):
     """Download a file from the PermastoreIt network"""
-    file_path = node.retrieve_file(file_hash)
-    if not file_path:
+    result = node.retrieve_file(file_hash)
+    if not result:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path, filename=file_hash)
+    file_path, stat = result
+    return LargeFileResponse(file_path, filename=file_hash, stat_result=stat)
 
 @app.post("/peers")
 async def add_peer(peer: PeerModel):
     """Add a peer to the PermastoreIt network"""
-    if node.network.add_peer(peer.url):
+    if await node.network.add_peer(peer.url):
         return {"message": f"Peer added: {peer.url}"}
     raise HTTPException(status_code=400, detail="Failed to add peer")
 
@@ -115,17 +134,14 @@ async def get_peers():
 @app.post("/sync")
 async def sync_files():
     """Synchronize files with peers"""
-    result = node.network.sync_files()
+    result = await node.network.sync_files()
     return result
 
 @app.get("/status", response_model=StatusResponse)
 async def get_status():
     """Get status information about the node"""
-    return {
-        "blockchain_length": len(node.blockchain.chain),
-        "peers": list(node.network.peers),
-        "last_block": node.blockchain.get_last_block()
-    }
+    # Serve the prebuilt payload directly, skipping response model validation
+    return Response(content=node.get_status(), media_type="application/json")
 
 @app.get("/health")
 async def health_check():
@@ -148,5 +164,7 @@ if __name__ == "__main__":
         "server:app", 
         host=config["host"], 
         port=config["port"], 
-        reload=config["debug"]
+        reload=config["debug"],
+        loop=config.get("loop", "auto"),
+        http=config.get("http", "auto")
     )
\ No newline at end of file